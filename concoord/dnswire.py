@@ -0,0 +1,49 @@
+"""
+@author: Deniz Altinbuken, Emin Gun Sirer
+@note: Byte-level DNS wire format helpers for the Nameserver. Kept free of
+class state so the module can be compiled with Cython when it is available.
+@copyright: See LICENSE
+"""
+import struct
+
+# Precompiled (qtype, qclass) unpacker, saves a format parse and a
+# global lookup per packet
+unpack_qfields = struct.Struct("!HH").unpack_from
+
+def peek_question(data):
+    """Extracts (qname wire, qtype, qclass) of a single-question query
+    straight from the wire format, without parsing the packet."""
+    # qdcount lives at offset 4, the question section starts at 12; the
+    # smallest valid question is the root name plus qtype and qclass
+    datalen = len(data)
+    if datalen < 17 or data[4:6] != b'\x00\x01':
+        return None
+    # Only standard queries: a set QR bit means this is a response, not
+    # a query, and answering it would bounce traffic back and forth
+    # between two servers; a nonzero opcode is not a QUERY either
+    if data[2] & 0xf8:
+        return None
+    index = 12
+    length = data[index]
+    while length:
+        if length > 63: # compressed or malformed label
+            return None
+        index += length + 1
+        # room for the next length byte plus qtype and qclass
+        if index + 4 >= datalen:
+            return None
+        length = data[index]
+    # Label lengths are at most 63, so lowercasing the raw bytes only
+    # touches the characters of the name itself
+    qname = data[12:index+1].lower()
+    qtype, qclass = unpack_qfields(data, index+1)
+    return qname, qtype, qclass
+
+def name_to_wire(name):
+    """Encodes a dotted absolute name into wire-format labels."""
+    wire = []
+    for label in name.rstrip('.').split('.'):
+        label = label.encode()
+        wire.append(struct.pack("B", len(label)) + label)
+    wire.append(b'\x00')
+    return b''.join(wire)
@@ -4,10 +4,16 @@
 @copyright: See LICENSE
 """
 import socket, select, signal
+import array
+import mmap
+import pickle
+import struct
+import time
 from time import strftime, gmtime
 from concoord.utils import *
 from concoord.enums import *
 from concoord.pack import *
+from concoord.dnswire import peek_question, name_to_wire
 
 try:
     import dns.exception
@@ -15,25 +21,83 @@ try:
     import dns.rcode
     import dns.opcode
     import dns.rdatatype
+    import dns.rrset
     import dns.name
     from dns.flags import *
 except ImportError:
     print("To use the nameserver install dnspython: http://www.dnspython.org/")
-
-RRTYPE = ['','A','NS','MD','MF','CNAME','SOA', 'MB', 'MG', 'MR', 'NULL',
-          'WKS', 'PTR', 'HINFO', 'MINFO', 'MX', 'TXT', 'RP', 'AFSDB',
-          'X25', 'ISDN', 'RT', 'NSAP', 'NSAP_PTR', 'SIG', 'KEY', 'PX',
-          'GPOS', 'AAAA', 'LOC', 'NXT', '', '', 'SRV']
-RRCLASS = ['','IN','CS','CH','HS']
-OPCODES = ['QUERY','IQUERY','STATUS']
-RCODES = ['NOERROR','FORMERR','SERVFAIL','NXDOMAIN','NOTIMP','REFUSED']
+else:
+    # The only record types the nameserver answers for
+    ANSWERABLE_RDTYPES = frozenset((dns.rdatatype.A, dns.rdatatype.AAAA,
+                                    dns.rdatatype.TXT, dns.rdatatype.NS,
+                                    dns.rdatatype.SRV, dns.rdatatype.SOA))
 
 SRVNAME = '_concoord._tcp.'
 
+# Answers are created with a 30 second TTL. Cached wire responses are
+# evicted a safety margin earlier so a client never sees a stale view
+# for longer than the TTL promises.
+ANSWERTTL = 30
+CACHESAFETY = 5
+
+# SOA timers
+SOAREFRESH = 86000 # time (in seconds) when the slave DNS server will refresh from the master
+SOARETRY = 7200    # time (in seconds) when the slave DNS server should retry contacting a failed master
+SOAEXPIRY = 360000 # time (in seconds) that a slave server will keep a cached zone file as valid
+SOAMINIMUM = 432000 # default time (in seconds) that the slave servers should cache the Zone file
+
+# Response flags: QR (response) and AA (authoritative answer)
+FLAGQR = 0x8000
+FLAGAA = 0x0400
+
+# Size of the shared mmap through which the parent publishes view
+# snapshots to SO_REUSEPORT worker processes
+VIEWMAPLEN = 1 << 16
+
+# Socket buffers large enough to absorb query bursts that arrive while
+# the server is busy; the OS default is often a few hundred KB and
+# silently drops datagrams once full
+UDPBUFLEN = 4 * 1024 * 1024
+
+# Batched UDP I/O: recvmmsg/sendmmsg move a whole burst of datagrams in
+# one syscall. They are Linux-only, so the server loop falls back to the
+# recvfrom/sendto drain loop when the libc does not export them.
+MMSGBATCH = 64
+MSG_WAITFORONE = 0x10000
+SOCKADDRLEN = 16
+
+try:
+    import ctypes
+    import ctypes.util
+    libmmsg = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libmmsg.recvmmsg
+    libmmsg.sendmmsg
+except (OSError, AttributeError):
+    libmmsg = None
+
+if libmmsg:
+    class Iovec(ctypes.Structure):
+        _fields_ = [('iov_base', ctypes.c_void_p),
+                    ('iov_len', ctypes.c_size_t)]
+
+    class Msghdr(ctypes.Structure):
+        _fields_ = [('msg_name', ctypes.c_void_p),
+                    ('msg_namelen', ctypes.c_uint),
+                    ('msg_iov', ctypes.POINTER(Iovec)),
+                    ('msg_iovlen', ctypes.c_size_t),
+                    ('msg_control', ctypes.c_void_p),
+                    ('msg_controllen', ctypes.c_size_t),
+                    ('msg_flags', ctypes.c_int)]
+
+    class Mmsghdr(ctypes.Structure):
+        _fields_ = [('msg_hdr', Msghdr),
+                    ('msg_len', ctypes.c_uint)]
+
 class Nameserver():
     """Nameserver keeps track of the connectivity state of the system and replies to
     QUERY messages from dnsserver."""
-    def __init__(self, addr, domain, replicas, debug):
+    def __init__(self, addr, domain, replicas, debug, num_workers=None,
+                 rcvbuf=UDPBUFLEN, sndbuf=UDPBUFLEN):
         self.ipconverter = '.ipaddr.'+domain+'.'
         try:
             if domain.find('.') > 0:
@@ -45,180 +109,527 @@ class Nameserver():
             print("A DNS name is required. Use -n option.")
             raise e
 
+        # Wire forms of the names we answer for, so that incoming packets
+        # can be classified without being parsed first
+        if isinstance(self.mydomain, dns.name.Name):
+            self.mydomain_wire = self.mydomain.to_wire().lower()
+        else:
+            self.mydomain_wire = None
+        self.mysrvdomain_wire = self.mysrvdomain.to_wire().lower()
+
         # Replicas of the Replica
         self.replicas = replicas
         self.debug = debug
+        # Bound once in add_logger: the logger's write when debugging,
+        # None otherwise, so per-packet code tests a single reference and
+        # skips the message formatting entirely when logging is off
+        self._log = None
+
+        # Worker processes serving queries next to this one, each on its
+        # own SO_REUSEPORT socket so the kernel spreads datagrams across
+        # cores without the GIL in the way
+        if num_workers:
+            self.num_workers = num_workers
+        elif hasattr(socket, 'SO_REUSEPORT'):
+            self.num_workers = os.cpu_count()
+        else:
+            self.num_workers = 1
+        self.viewmap = None
+        # Set in the forked children: only workers read view snapshots
+        # back out of the mmap, the parent shares Node.replicas directly
+        self.isworker = False
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
 
         self.addr = addr if addr else findOwnIP()
         self.udpport = 53
-        self.udpsocket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        self.udpsocket = self.create_udp_socket()
         try:
             self.udpsocket.bind((self.addr,self.udpport))
             print("Connected to " + self.addr + ":" + str(self.udpport))
         except socket.error as e:
             print("Can't bind to UDP port 53: %s" % str(e))
             raise e
+        # The server loop drains the socket until it would block
+        self.udpsocket.setblocking(False)
+
+        self.usemmsg = libmmsg is not None
+        if self.usemmsg:
+            self.init_mmsg()
 
         # When the nameserver starts the revision number is 00 for that day
-        self.revision = strftime("%Y%m%d", gmtime())+str(0).zfill(2)
+        self._today = strftime("%Y%m%d", gmtime())
+        self._today_checked = time.monotonic()
+        self._rev_day = self._today
+        self._rev_seq = 0
+        self.revision = '%s%02d' % (self._rev_day, self._rev_seq)
+
+        # The SOA rdata only changes when the revision does; both its
+        # renderings are cached keyed by the revision they were built from
+        self._soa_mname = str(self.mydomain)
+        self._soa_rname = 'dns-admin.'+self._soa_mname
+        self._soa_names_wire = name_to_wire(self._soa_mname) + name_to_wire(self._soa_rname)
+        self._soa_rev = None
+
+        # Cache of complete wire-format responses keyed by (rdtype, qname wire).
+        # The view changes rarely, so most queries can be answered by patching
+        # the transaction id of a previously built response. Entries map to
+        # (wire, inserttime) and are invalidated when the view changes.
+        self._wire_cache = {}
+        self._view_version = 0
+        # Pre-rendered answer data per qtype, rebuilt lazily whenever the
+        # view version moves past the version it was rendered for
+        self._cached_version = -1
 
     def add_logger(self, logger):
         self.logger = logger
+        self._log = logger.write if self.debug else None
+
+    def create_udp_socket(self):
+        udpsocket = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            udpsocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # Enlarge the socket buffers so query bursts are queued instead
+        # of dropped
+        udpsocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        udpsocket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        # The kernel doubles the requested size for bookkeeping; less
+        # than that means it clamped the request (see net.core.rmem_max)
+        if udpsocket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) < 2 * self.rcvbuf:
+            print("UDP receive buffer clamped to %d bytes, raise net.core.rmem_max"
+                  % udpsocket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+        if udpsocket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) < 2 * self.sndbuf:
+            print("UDP send buffer clamped to %d bytes, raise net.core.wmem_max"
+                  % udpsocket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+        return udpsocket
+
+    def start(self):
+        """Serves DNS queries, forking num_workers-1 worker processes that
+        bind their own SO_REUSEPORT sockets first. The parent publishes
+        view changes to the workers through a pickled snapshot in an
+        anonymous mmap, refreshed by update()."""
+        if self.num_workers > 1 and hasattr(socket, 'SO_REUSEPORT'):
+            self.viewmap = mmap.mmap(-1, VIEWMAPLEN)
+            self.write_view_snapshot()
+            for i in range(self.num_workers - 1):
+                if os.fork() == 0:
+                    self.isworker = True
+                    self.udpsocket = self.create_udp_socket()
+                    self.udpsocket.bind((self.addr,self.udpport))
+                    self.udpsocket.setblocking(False)
+                    self.udp_server_loop()
+                    os._exit(0)
+        self.udp_server_loop()
+
+    def write_view_snapshot(self):
+        if self.viewmap is None:
+            return
+        snapshot = pickle.dumps((dict(self.replicas), self.revision))
+        # Payload first, version word last, so a worker that sees the new
+        # version never unpickles the previous snapshot under it
+        self.viewmap.seek(8)
+        self.viewmap.write(snapshot)
+        self.viewmap.seek(0)
+        self.viewmap.write(struct.pack("II", self._view_version, len(snapshot)))
+
+    def check_view(self):
+        """In worker processes, picks up view snapshots published by the
+        parent since the fork."""
+        version, length = struct.unpack_from("II", self.viewmap, 0)
+        if version != self._view_version:
+            try:
+                self.replicas, self.revision = pickle.loads(self.viewmap[8:8+length])
+            except Exception:
+                # The parent is mid-write; a torn read can surface as
+                # UnpicklingError, EOFError or worse, retry on the next
+                # wakeup either way
+                return
+            self._view_version = version
+            self._wire_cache.clear()
 
     def udp_server_loop(self):
+        if self.usemmsg:
+            self.mmsg_server_loop()
+            return
         while True:
             try:
                 inputready,outputready,exceptready = select.select([self.udpsocket],[],[self.udpsocket])
                 for s in exceptready:
-                    if self.debug: self.logger.write("DNS Error", s)
+                    if self._log: self._log("DNS Error", s)
                 for s in inputready:
-                    data,clientaddr = self.udpsocket.recvfrom(UDPMAXLEN)
-                    if self.debug: self.logger.write("DNS State", "received a message from address %s" % str(clientaddr))
-                    self.handle_query(data,clientaddr)
+                    self.drain_udp_socket()
             except (KeyboardInterrupt, EOFError):
                 os._exit(0)
             except Exception as e:
-                print("Error:", type(e), e.message)
+                print("Error:", type(e), e)
                 continue
         self.udpsocket.close()
         return
 
+    def mmsg_server_loop(self):
+        # With a single UDP socket the select wakeup is pure overhead:
+        # block straight in recvmmsg and let MSG_WAITFORONE hand over the
+        # whole queue as soon as one datagram arrives, so a burst is
+        # received, answered and flushed in one submit/complete round.
+        self.udpsocket.setblocking(True)
+        while True:
+            try:
+                self.process_mmsg_batch(MSG_WAITFORONE)
+            except (KeyboardInterrupt, EOFError):
+                os._exit(0)
+            except Exception as e:
+                print("Error:", type(e), e)
+                continue
+
+    def init_mmsg(self):
+        """Preallocates the recvmmsg buffer pool, reused for every batch."""
+        self.recvbufs = [ctypes.create_string_buffer(UDPMAXLEN) for i in range(MMSGBATCH)]
+        self.recvaddrs = [ctypes.create_string_buffer(SOCKADDRLEN) for i in range(MMSGBATCH)]
+        self.recviovecs = (Iovec * MMSGBATCH)()
+        self.recvmsgs = (Mmsghdr * MMSGBATCH)()
+        for i in range(MMSGBATCH):
+            self.recviovecs[i].iov_base = ctypes.cast(self.recvbufs[i], ctypes.c_void_p)
+            self.recviovecs[i].iov_len = UDPMAXLEN
+            hdr = self.recvmsgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(self.recvaddrs[i], ctypes.c_void_p)
+            hdr.msg_namelen = SOCKADDRLEN
+            hdr.msg_iov = ctypes.pointer(self.recviovecs[i])
+            hdr.msg_iovlen = 1
+
+    def sockaddr_to_addr(self, sockaddr):
+        port = struct.unpack_from("!H", sockaddr, 2)[0]
+        return (socket.inet_ntoa(sockaddr[4:8]), port)
+
+    def drain_udp_socket(self):
+        if self.isworker:
+            self.check_view()
+        # Drain the socket completely before selecting again, one
+        # syscall per datagram dominates under load
+        while True:
+            try:
+                data,clientaddr = self.udpsocket.recvfrom(UDPMAXLEN)
+            except BlockingIOError:
+                break
+            if self._log: self._log("DNS State", "received a message from address %s" % str(clientaddr))
+            self.handle_query(data,clientaddr)
+
+    def process_mmsg_batch(self, flags):
+        fd = self.udpsocket.fileno()
+        for i in range(MMSGBATCH):
+            self.recvmsgs[i].msg_hdr.msg_namelen = SOCKADDRLEN
+        rcvd = libmmsg.recvmmsg(fd, self.recvmsgs, MMSGBATCH, flags, None)
+        if rcvd <= 0:
+            # EAGAIN or EINTR, nothing to process
+            return rcvd
+        # Check for a new view after the blocking receive returns, so a
+        # worker that sat idle in recvmmsg never answers from a view
+        # checked before it went to sleep
+        if self.isworker:
+            self.check_view()
+        responses = []
+        for i in range(rcvd):
+            data = self.recvbufs[i].raw[:self.recvmsgs[i].msg_len]
+            if self._log:
+                clientaddr = self.sockaddr_to_addr(self.recvaddrs[i].raw)
+                self._log("DNS State", "received a message from address %s" % str(clientaddr))
+            try:
+                response = self.build_response(data)
+            except Exception:
+                # A malformed datagram only costs itself, not the rest
+                # of the batch
+                continue
+            if response is not None:
+                # The response goes back to the sockaddr it came from
+                responses.append((response, i))
+        if responses:
+            self.send_mmsg(responses)
+        return rcvd
+
+    def send_mmsg(self, responses):
+        fd = self.udpsocket.fileno()
+        count = len(responses)
+        bufs = []
+        iovecs = (Iovec * count)()
+        msgs = (Mmsghdr * count)()
+        for i, (response, j) in enumerate(responses):
+            buf = ctypes.create_string_buffer(response, len(response))
+            bufs.append(buf)
+            iovecs[i].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+            iovecs[i].iov_len = len(response)
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(self.recvaddrs[j], ctypes.c_void_p)
+            hdr.msg_namelen = SOCKADDRLEN
+            hdr.msg_iov = ctypes.pointer(iovecs[i])
+            hdr.msg_iovlen = 1
+        sent = 0
+        while sent < count:
+            ret = libmmsg.sendmmsg(fd, ctypes.byref(msgs, sent * ctypes.sizeof(Mmsghdr)), count - sent, 0)
+            if ret <= 0:
+                break
+            sent += ret
+
+    def _rebuild_view_cache(self):
+        """Re-renders the per-qtype answer data from the current view,
+        once per view change instead of once per query."""
+        # One pass of attribute access over the peers; the answer data is
+        # derived from these parallel arrays
+        peers = list(self.replicas)
+        self._replica_addrs = [peer.addr for peer in peers]
+        self._replica_ports = array.array('H', (peer.port for peer in peers))
+        self._replica_types = array.array('B', (peer.type for peer in peers))
+        self._cached_a = self._replica_addrs
+        self._cached_ns = [addr for addr,ptype in zip(self._replica_addrs, self._replica_types)
+                           if ptype == NODE_NAMESERVER]
+        self._cached_srv = [(addr+self.ipconverter, port)
+                            for addr,port in zip(self._replica_addrs, self._replica_ports)]
+        self._cached_txt = ';'.join(node_names[ptype] +' '+ addr + ':' + str(port)
+                                    for addr,port,ptype in zip(self._replica_addrs,
+                                                               self._replica_ports,
+                                                               self._replica_types))
+        # rdata text ready for dns.rrset.from_text_list, so building a
+        # response does no per-record formatting
+        self._cached_ns_rdata = [addr+'.' for addr in self._cached_ns]
+        self._cached_srv_rdata = ["0 100 %d %s" % (port, addr)
+                                  for addr,port in self._cached_srv]
+        self._cached_version = self._view_version
+        # Prime the wire cache with a template per answerable question,
+        # so even the first query after a view change is answered with a
+        # transaction-id patch
+        now = time.time()
+        if self.mydomain_wire is not None:
+            for qtype in ANSWERABLE_RDTYPES:
+                wire = self._encode_response(self.mydomain_wire, qtype, 1)
+                if wire is not None:
+                    self._wire_cache[(qtype, self.mydomain_wire)] = (wire, now)
+        wire = self._encode_response(self.mysrvdomain_wire, dns.rdatatype.SRV, 1)
+        if wire is not None:
+            self._wire_cache[(dns.rdatatype.SRV, self.mysrvdomain_wire)] = (wire, now)
+
     def aresponse(self, question=''):
-        for address in get_addresses(self.replicas):
-            yield address
+        if self._cached_version != self._view_version:
+            self._rebuild_view_cache()
+        return self._cached_a
 
     def nsresponse(self, question=''):
-        # Check which Replicas are also Nameservers
-        for replica in self.replicas:
-            if replica.type == NODE_NAMESERVER:
-                yield replica.addr
+        # The Replicas that are also Nameservers
+        if self._cached_version != self._view_version:
+            self._rebuild_view_cache()
+        return self._cached_ns
 
     def srvresponse(self, question=''):
-        for address,port in get_addressportpairs(self.replicas):
-            yield address+self.ipconverter,port
+        if self._cached_version != self._view_version:
+            self._rebuild_view_cache()
+        return self._cached_srv
 
     def txtresponse(self, question=''):
-        txtstr = ''
-        for peer in self.replicas:
-            txtstr += node_names[peer.type] +' '+ peer.addr + ':' + str(peer.port) + ';'
-        return txtstr[:-1]
+        if self._cached_version != self._view_version:
+            self._rebuild_view_cache()
+        return self._cached_txt
+
+    def nsrdata(self, question=''):
+        if self._cached_version != self._view_version:
+            self._rebuild_view_cache()
+        return self._cached_ns_rdata
+
+    def srvrdata(self, question=''):
+        if self._cached_version != self._view_version:
+            self._rebuild_view_cache()
+        return self._cached_srv_rdata
 
     def ismydomainname(self, question):
         return question.name == self.mydomain or (question.rdtype == dns.rdatatype.SRV and question.name == self.mysrvdomain)
 
     def should_answer(self, question):
-        return (question.rdtype == dns.rdatatype.AAAA or \
-                    question.rdtype == dns.rdatatype.A or \
-                    question.rdtype == dns.rdatatype.TXT or \
-                    question.rdtype == dns.rdatatype.NS or \
-                    question.rdtype == dns.rdatatype.SRV or \
-                    question.rdtype == dns.rdatatype.SOA) and self.ismydomainname(question)
+        return question.rdtype in ANSWERABLE_RDTYPES and self.ismydomainname(question)
+
+    def cache_lookup(self, key):
+        """Returns the cached wire response for key, evicting it if it is
+        about to outlive the TTL of the answers it carries."""
+        try:
+            wire, inserttime = self._wire_cache[key]
+        except KeyError:
+            return None
+        if time.time() - inserttime > ANSWERTTL - CACHESAFETY:
+            del self._wire_cache[key]
+            return None
+        return wire
+
+    def invalidate_cache(self):
+        self._view_version += 1
+        self._wire_cache.clear()
+
+    def _peek_question(self, data):
+        return peek_question(data)
+
+    def _encode_response(self, qname, qtype, qclass):
+        """Encodes the complete wire response for a peeked question with
+        struct.pack, bypassing dnspython. The transaction id is left zero
+        for the caller to patch in. Returns None for question shapes the
+        dnspython path should answer (or refuse) instead."""
+        if qname == self.mydomain_wire:
+            if qtype not in ANSWERABLE_RDTYPES:
+                return None
+        elif not (qtype == dns.rdatatype.SRV and qname == self.mysrvdomain_wire):
+            return None
+        flags = FLAGQR | FLAGAA
+        rdatas = []
+        if qtype == dns.rdatatype.A:
+            rdatas = [socket.inet_aton(addr) for addr in self.aresponse()]
+        elif qtype == dns.rdatatype.AAAA:
+            # No IPv6 addresses, reply without an answer section
+            flags = FLAGQR
+        elif qtype == dns.rdatatype.TXT:
+            txt = self.txtresponse().encode()
+            rdatas = [b''.join(struct.pack("B", len(txt[i:i+255])) + txt[i:i+255]
+                               for i in range(0, len(txt), 255)) or b'\x00']
+        elif qtype == dns.rdatatype.NS:
+            rdatas = [name_to_wire(name) for name in self.nsrdata()]
+        elif qtype == dns.rdatatype.SRV:
+            rdatas = [struct.pack("!HHH", 0, 100, port) + name_to_wire(addr)
+                      for addr,port in self.srvresponse()]
+        elif qtype == dns.rdatatype.SOA:
+            if self._soa_rev != self.revision:
+                self._refresh_soa_rdata()
+            rdatas = [self._soa_wire]
+        header = struct.pack("!HHHHHH", 0, flags, 1, len(rdatas), 0, 0)
+        question = qname + struct.pack("!HH", qtype, qclass)
+        # 0xc00c: compression pointer to the question name at offset 12
+        answer = b''.join(b'\xc0\x0c' +
+                          struct.pack("!HHIH", qtype, 1, ANSWERTTL, len(rdata)) + rdata
+                          for rdata in rdatas)
+        return header + question + answer
 
     def handle_query(self, data, addr):
+        response = self.build_response(data)
+        if response is not None:
+            self.udpsocket.sendto(response, addr)
+
+    def build_response(self, data):
+        """Returns the wire-format response for one query packet, or None
+        if the query should not be answered."""
+        key = None
+        peeked = self._peek_question(data)
+        if peeked is not None:
+            qname, qtype, qclass = peeked
+            if self.mydomain_wire is not None and qname != self.mydomain_wire and \
+                    not (qtype == dns.rdatatype.SRV and qname == self.mysrvdomain_wire):
+                # Not for my domain, drop it without parsing
+                return None
+            # Only IN-class questions go through the cache: the cached
+            # wire bytes embed the question section verbatim, so an odd
+            # qclass would poison the entry for every later client
+            if qclass == 1:
+                # The peek lowercased the name for the cache key; the
+                # response must echo the query's original case or 0x20
+                # case-randomizing resolvers discard it as a spoof
+                key = (qtype, qname)
+                cached = self.cache_lookup(key)
+                if cached is not None:
+                    # Patch the cached response with the transaction id
+                    # and question name of this query and send it as is.
+                    response = bytearray(cached)
+                    response[0:2] = data[0:2]
+                    response[12:12+len(qname)] = data[12:12+len(qname)]
+                    return bytes(response)
+                wire = self._encode_response(qname, qtype, qclass)
+                if wire is not None:
+                    self._wire_cache[key] = (wire, time.time())
+                    response = bytearray(wire)
+                    response[0:2] = data[0:2]
+                    response[12:12+len(qname)] = data[12:12+len(qname)]
+                    return bytes(response)
         query = dns.message.from_wire(data)
         response = dns.message.make_response(query)
         for question in query.question:
-            if self.debug: self.logger.write("DNS State", "Received Query for %s\n" % question.name)
-            if self.debug: self.logger.write("DNS State", "Mydomainname: %s Questionname: %s" % (self.mydomain, str(question.name)))
+            if self._log: self._log("DNS State", "Received Query for %s\n" % question.name)
+            if self._log: self._log("DNS State", "Mydomainname: %s Questionname: %s" % (self.mydomain, str(question.name)))
             if self.should_answer(question):
-                if self.debug: self.logger.write("DNS State", "Query for my domain: %s" % str(question))
-                flagstr = 'QR AA' # response, authoritative
-                answerstr = ''
+                if self._log: self._log("DNS State", "Query for my domain: %s" % str(question))
+                rrset = None
                 if question.rdtype == dns.rdatatype.AAAA:
-                    flagstr = 'QR' # response
+                    # No IPv6 addresses, reply without an answer section
+                    pass
                 elif question.rdtype == dns.rdatatype.A:
                     # A Queries --> List all Replicas starting with the Leader
-                    for address in self.aresponse(question):
-                        answerstr += self.create_answer_section(question, addr=address)
+                    rrset = dns.rrset.from_text_list(question.name, ANSWERTTL, 'IN', 'A',
+                                                     self.aresponse(question))
                 elif question.rdtype == dns.rdatatype.TXT:
                     # TXT Queries --> List all nodes
-                    answerstr = self.create_answer_section(question, txt=self.txtresponse(question))
+                    rrset = dns.rrset.from_text(question.name, ANSWERTTL, 'IN', 'TXT',
+                                                '"%s"' % self.txtresponse(question))
                 elif question.rdtype == dns.rdatatype.NS:
                     # NS Queries --> List all Nameserver nodes
-                    for address in self.nsresponse(question):
-                        #answerstr += self.create_answer_section(question, name=address)
-                        answerstr += self.create_answer_section(question, addr=address)
+                    rrset = dns.rrset.from_text_list(question.name, ANSWERTTL, 'IN', 'NS',
+                                                     self.nsrdata(question))
                 elif question.rdtype == dns.rdatatype.SOA:
                     # SOA Query --> Reply with Metadata
-                    answerstr = self.create_soa_answer_section(question)
+                    rrset = dns.rrset.from_text(question.name, ANSWERTTL, 'IN', 'SOA',
+                                                self.create_soa_rdata(question))
                 elif question.rdtype == dns.rdatatype.SRV:
                     # SRV Queries --> List all Replicas with addr:port
-                    for address,port in self.srvresponse(question):
-                        answerstr += self.create_srv_answer_section(question, addr=address, port=port)
-                responsestr = self.create_response(response.id,opcode=dns.opcode.QUERY,
-                                                   rcode=dns.rcode.NOERROR,flags=flagstr,
-                                                   question=question.to_text(),answer=answerstr,
-                                                   authority='',additional='')
-                response = dns.message.from_text(responsestr)
+                    rrset = dns.rrset.from_text_list(question.name, ANSWERTTL, 'IN', 'SRV',
+                                                     self.srvrdata(question))
+                if question.rdtype != dns.rdatatype.AAAA:
+                    response.flags |= AA # authoritative
+                if rrset is not None:
+                    response.answer.append(rrset)
             else:
-                if self.debug: self.logger.write("DNS State", "UNSUPPORTED QUERY, %s" %str(question))
-                return
-        if self.debug: self.logger.write("DNS State", "RESPONSE:\n%s\n---\n" % str(response))
+                if self._log: self._log("DNS State", "UNSUPPORTED QUERY, %s" %str(question))
+                return None
+        if self._log: self._log("DNS State", "RESPONSE:\n%s\n---\n" % str(response))
 
         towire = response.to_wire()
-        self.udpsocket.sendto(towire, addr)
-
-    def create_response(self, id, opcode=0, rcode=0, flags='', question='', answer='', authority='', additional=''):
-        answerstr     = ';ANSWER\n'     + answer     + '\n' if answer != '' else ''
-        authoritystr  = ';AUTHORITY\n'  + authority  + '\n' if authority != '' else ''
-        additionalstr = ';ADDITIONAL\n' + additional + '\n' if additional != '' else ''
-
-        responsestr = "id %s\nopcode %s\nrcode %s\nflags %s\n;QUESTION\n%s\n%s%s%s" % (str(id),
-                                                                                       OPCODES[opcode],
-                                                                                       RCODES[rcode],
-                                                                                       flags,
-                                                                                       question,
-                                                                                       answerstr, authoritystr, additionalstr)
-        return responsestr
-
-    def create_srv_answer_section(self, question, ttl=30, rrclass=1, priority=0, weight=100, port=None, addr=''):
-        answerstr = "%s %d %s %s %d %d %d %s\n" % (str(question.name), ttl, RRCLASS[rrclass], RRTYPE[question.rdtype], priority, weight, port, addr)
-        return answerstr
-
-    def create_mx_answer_section(self, question, ttl=30, rrclass=1, priority=0, addr=''):
-        answerstr = "%s %d %s %s %d %s\n" % (str(question.name), ttl, RRCLASS[rrclass], RRTYPE[question.rdtype], priority, addr)
-        return answerstr
-
-    def create_soa_answer_section(self, question, ttl=30, rrclass=1):
-        refreshrate = 86000 # time (in seconds) when the slave DNS server will refresh from the master
-        updateretry = 7200  # time (in seconds) when the slave DNS server should retry contacting a failed master
-        expiry = 360000     # time (in seconds) that a slave server will keep a cached zone file as valid
-        minimum = 432000    # default time (in seconds) that the slave servers should cache the Zone file
-        answerstr = "%s %d %s %s %s %s (%s %d %d %d %d)" % (str(question.name), ttl, RRCLASS[rrclass],
-                                                            RRTYPE[question.rdtype],
-                                                            str(self.mydomain),
-                                                            'dns-admin.'+str(self.mydomain),
-                                                            self.revision,
-                                                            refreshrate,
-                                                            updateretry,
-                                                            expiry,
-                                                            minimum)
-        return answerstr
-
-    def create_answer_section(self, question, ttl=30, rrclass=1, addr='', txt=None):
-        if question.rdtype == dns.rdatatype.A:
-            resp = str(addr)
-        elif question.rdtype == dns.rdatatype.TXT:
-            resp = '"%s"' % txt
-        elif question.rdtype == dns.rdatatype.NS:
-            resp = str(addr)
-        answerstr = "%s %s %s %s %s\n" % (str(question.name), str(ttl), str(RRCLASS[rrclass]), str(RRTYPE[question.rdtype]), resp)
-        return answerstr
-
-    def create_authority_section(self, question, ttl='30', rrclass=1, rrtype=1, nshost=''):
-        authoritystr = "%s %s %s %s %s\n" % (str(question.name), str(ttl), str(RRCLASS[rrclass]), str(RRTYPE[rrtype]), str(nshost))
-        return authoritystr
-
-    def create_additional_section(self, question, ttl='30', rrclass=1, rrtype=1, addr=''):
-        additionalstr = "%s %s %s %s %s\n" % (str(question.name), str(ttl), str(RRCLASS[rrclass]), str(RRTYPE[rrtype]), str(addr))
-        return additionalstr
+        if key is not None:
+            self._wire_cache[key] = (towire, time.time())
+        return towire
+
+    def _refresh_soa_rdata(self):
+        self._soa_text = "%s %s %s %d %d %d %d" % (self._soa_mname,
+                                                   self._soa_rname,
+                                                   self.revision,
+                                                   SOAREFRESH,
+                                                   SOARETRY,
+                                                   SOAEXPIRY,
+                                                   SOAMINIMUM)
+        self._soa_wire = self._soa_names_wire + struct.pack("!IIIII",
+                                                            int(self.revision),
+                                                            SOAREFRESH,
+                                                            SOARETRY,
+                                                            SOAEXPIRY,
+                                                            SOAMINIMUM)
+        self._soa_rev = self.revision
+
+    def create_soa_rdata(self, question):
+        if self._soa_rev != self.revision:
+            self._refresh_soa_rdata()
+        return self._soa_text
+
+    def get_today(self):
+        """Returns the UTC day stamp, going through strftime/gmtime at
+        most once a minute."""
+        now = time.monotonic()
+        if now - self._today_checked >= 60:
+            self._today = strftime("%Y%m%d", gmtime())
+            self._today_checked = now
+        return self._today
 
     def update(self):
         if self.debug: self.logger.write("State", "Updating Revision -- from: %s" % self.revision)
-        if strftime("%Y%m%d", gmtime()) in self.revision:
-            rno = int(self.revision[-2]+self.revision[-1])
-            rno += 1
-            self.revision = strftime("%Y%m%d", gmtime())+str(rno).zfill(2)
+        today = self.get_today()
+        if today == self._rev_day:
+            # The serial must stay two digits to fit in the SOA's 32-bit
+            # field; after the 100th view change of a day it sticks at 99
+            # until the day stamp rolls over
+            if self._rev_seq < 99:
+                self._rev_seq += 1
         else:
-            self.revision = strftime("%Y%m%d", gmtime())+str(0).zfill(2)
+            self._rev_day = today
+            self._rev_seq = 0
+        self.revision = '%s%02d' % (self._rev_day, self._rev_seq)
         if self.debug: self.logger.write("State", "Updating Revision -- to: %s" % self.revision)
+        # The view changed, cached responses are stale. Invalidate after
+        # the revision bump so a concurrent query cannot re-cache a
+        # response carrying the old SOA serial.
+        self.invalidate_cache()
+        # Publish the new view to the SO_REUSEPORT workers
+        self.write_view_snapshot()
@@ -130,7 +130,7 @@ class Replica(Node):
         if self.isnameserver:
             if self.debug: self.logger.write("State", "Starting the Nameserver Thread.")
             # Start a thread for the UDP server
-            UDP_server_thread = Thread(target=self.nameserver.udp_server_loop, name='UDPServerThread')
+            UDP_server_thread = Thread(target=self.nameserver.start, name='UDPServerThread')
             UDP_server_thread.start()
 
     @staticmethod
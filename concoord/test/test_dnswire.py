@@ -0,0 +1,167 @@
+# Tests the byte-level DNS wire helpers and the fast response path
+# against dnspython's own parser. Needs no running replicas.
+import struct
+import time
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rdatatype
+
+from concoord.enums import *
+from concoord.pack import Peer
+from concoord.dnswire import peek_question, name_to_wire
+from concoord.nameserver import Nameserver, ANSWERTTL
+
+DOMAIN = 'test.org'
+
+def query_wire(qname, qtype, rdclass='IN'):
+    return dns.message.make_query(qname, qtype, rdclass=rdclass).to_wire()
+
+def make_nameserver():
+    # Nameserver.__init__ binds UDP port 53, so the test assembles the
+    # response-path state by hand instead
+    ns = Nameserver.__new__(Nameserver)
+    ns.ipconverter = '.ipaddr.'+DOMAIN+'.'
+    ns.mydomain = dns.name.Name((DOMAIN+'.').split('.'))
+    ns.mysrvdomain = dns.name.Name(('_concoord._tcp.'+DOMAIN+'.').split('.'))
+    ns.mydomain_wire = ns.mydomain.to_wire().lower()
+    ns.mysrvdomain_wire = ns.mysrvdomain.to_wire().lower()
+    ns.replicas = {Peer('10.0.0.1', 14000, NODE_REPLICA): 0,
+                   Peer('10.0.0.2', 14001, NODE_NAMESERVER): 1}
+    ns.debug = False
+    ns._log = None
+    ns.viewmap = None
+    ns._today = '20260831'
+    ns._today_checked = time.monotonic()
+    ns._rev_day = ns._today
+    ns._rev_seq = 0
+    ns.revision = '%s%02d' % (ns._rev_day, ns._rev_seq)
+    ns._soa_mname = str(ns.mydomain)
+    ns._soa_rname = 'dns-admin.'+ns._soa_mname
+    ns._soa_names_wire = name_to_wire(ns._soa_mname) + name_to_wire(ns._soa_rname)
+    ns._soa_rev = None
+    ns._wire_cache = {}
+    ns._view_version = 0
+    ns._cached_version = -1
+    return ns
+
+def test_peek_question():
+    wire = query_wire(DOMAIN+'.', 'A')
+    qname, qtype, qclass = peek_question(wire)
+    assert qname == ns_wire_name(DOMAIN+'.')
+    assert qtype == dns.rdatatype.A
+    assert qclass == 1
+
+def ns_wire_name(name):
+    return dns.name.from_text(name).to_wire().lower()
+
+def test_peek_lowercases_qname():
+    wire = query_wire('TeSt.OrG.', 'A')
+    qname, qtype, qclass = peek_question(wire)
+    assert qname == ns_wire_name(DOMAIN+'.')
+
+def test_peek_root_name():
+    wire = query_wire('.', 'NS')
+    qname, qtype, qclass = peek_question(wire)
+    assert qname == b'\x00'
+    assert qtype == dns.rdatatype.NS
+
+def test_peek_truncated():
+    wire = query_wire(DOMAIN+'.', 'A')
+    # No prefix of a valid query parses as one
+    for cut in range(len(wire)):
+        assert peek_question(wire[:cut]) is None
+
+def test_peek_compression_pointer():
+    wire = bytearray(query_wire(DOMAIN+'.', 'A'))
+    # A compression pointer in the question name (0xc0 upper bits)
+    wire[12] = 0xc0
+    assert peek_question(bytes(wire)) is None
+
+def test_peek_qdcount():
+    wire = bytearray(query_wire(DOMAIN+'.', 'A'))
+    for qdcount in (0, 2):
+        wire[4:6] = struct.pack("!H", qdcount)
+        assert peek_question(bytes(wire)) is None
+
+def test_peek_rejects_responses():
+    # A response answered as a query reflects between two servers forever
+    wire = bytearray(query_wire(DOMAIN+'.', 'A'))
+    wire[2] |= 0x80  # QR
+    assert peek_question(bytes(wire)) is None
+    wire = bytearray(query_wire(DOMAIN+'.', 'A'))
+    wire[2] |= 0x20  # opcode NOTIFY
+    assert peek_question(bytes(wire)) is None
+
+def test_name_to_wire():
+    for name in (DOMAIN+'.', 'a.b.c.', '_concoord._tcp.test.org.'):
+        assert name_to_wire(name) == dns.name.from_text(name).to_wire()
+
+def test_response_roundtrip():
+    ns = make_nameserver()
+    expected = {'A': {'10.0.0.1', '10.0.0.2'},
+                'NS': {'10.0.0.2.'},
+                'SRV': {'10.0.0.1.ipaddr.test.org.', '10.0.0.2.ipaddr.test.org.'}}
+    for rdtype in ('A', 'AAAA', 'TXT', 'NS', 'SOA'):
+        query = query_wire(DOMAIN+'.', rdtype)
+        # Once through the encoder, once through the cache
+        for i in range(2):
+            response = dns.message.from_wire(ns.build_response(query))
+            assert response.id == struct.unpack_from("!H", query)[0]
+            assert response.flags & dns.flags.QR
+            question = response.question[0]
+            assert question.name == ns.mydomain
+            assert question.rdtype == dns.rdatatype.from_text(rdtype)
+            assert question.rdclass == 1
+            if rdtype == 'AAAA':
+                assert not response.answer
+                continue
+            assert response.flags & dns.flags.AA
+            rrset = response.answer[0]
+            assert rrset.ttl == ANSWERTTL
+            if rdtype in expected:
+                assert {str(rr).split()[-1].rstrip('.')+'.' if rdtype != 'A'
+                        else str(rr) for rr in rrset} == expected[rdtype]
+            elif rdtype == 'SOA':
+                assert rrset[0].serial == int(ns.revision)
+            elif rdtype == 'TXT':
+                text = b''.join(rrset[0].strings).decode()
+                assert '10.0.0.1:14000' in text and '10.0.0.2:14001' in text
+
+def test_srv_roundtrip():
+    ns = make_nameserver()
+    query = query_wire('_concoord._tcp.'+DOMAIN+'.', 'SRV')
+    response = dns.message.from_wire(ns.build_response(query))
+    assert response.question[0].name == ns.mysrvdomain
+    ports = {rr.port for rr in response.answer[0]}
+    assert ports == {14000, 14001}
+
+def test_off_domain_dropped():
+    ns = make_nameserver()
+    assert ns.build_response(query_wire('other.org.', 'A')) is None
+
+def test_echoes_query_case():
+    ns = make_nameserver()
+    # 0x20 case-randomizing resolvers discard responses that do not echo
+    # the question name byte for byte
+    for i in range(2):
+        query = query_wire('TeSt.OrG.', 'A')
+        response = dns.message.from_wire(ns.build_response(query))
+        assert str(response.question[0].name) == 'TeSt.OrG.'
+
+def test_cache_isolates_qclass():
+    ns = make_nameserver()
+    # A CHAOS-class query must not leave an entry the next IN client gets
+    ns.build_response(query_wire(DOMAIN+'.', 'TXT', rdclass='CH'))
+    response = dns.message.from_wire(ns.build_response(query_wire(DOMAIN+'.', 'TXT')))
+    assert response.question[0].rdclass == 1
+
+def main():
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, "passed")
+
+if __name__ == '__main__':
+    main()
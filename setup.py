@@ -5,6 +5,14 @@ import sys
 from setuptools import setup
 from setuptools import find_packages
 
+# The DNS wire format helpers compile cleanly with Cython for faster
+# per-packet parsing, but plain Python works just as well
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize(['concoord/dnswire.py'], language_level=3)
+except ImportError:
+    ext_modules = []
+
 classifiers = [
     'Development Status :: 3 - Alpha',
     'Intended Audience :: Developers',
@@ -23,6 +31,7 @@ setup(
     author='Deniz Altinbuken, Emin Gun Sirer',
     author_email='deniz@systems.cs.cornell.edu, egs@systems.cs.cornell.edu',
     packages=find_packages(),
+    ext_modules=ext_modules,
     license='3-Clause BSD',
     url='http://openreplica.org/',
     description='Coordination service for distributed systems.',